@@ -4,21 +4,269 @@
 Script to print top 10 hot posts on a given Reddit subreddit.
 """
 
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import ijson
+    _PARSE_ERRORS = (ValueError, KeyError, TypeError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    _PARSE_ERRORS = (ValueError, KeyError, TypeError)
+# the ijson path reads res.raw, so urllib3 errors are not wrapped by requests
+_FETCH_ERRORS = (requests.exceptions.RequestException,
+                 urllib3.exceptions.HTTPError) + _PARSE_ERRORS
 
-def top_ten(subreddit):
-    """"top ten"""
-    url = "https://www.reddit.com/r/{}/hot.json?limit=10" \
-        .format(subreddit)
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+_HEADERS = {'User-Agent': 'Mozilla/5.0',
+            'Accept-Encoding': 'gzip, deflate'}
+
+_SESSION = requests.Session()
+_SESSION.headers.update(_HEADERS)
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4,
+                                       pool_maxsize=10,
+                                       max_retries=Retry(total=0, connect=0,
+                                                         read=0)))
+
+# prepared once and copied per call, so Session.send skips the merge step;
+# the CA bundle and client cert that merge would read from the environment
+# (REQUESTS_CA_BUNDLE, CURL_CA_BUNDLE) are resolved here once instead
+_REQ = requests.Request('GET', 'https://www.reddit.com/',
+                        headers=_SESSION.headers).prepare()
+_ENV = _SESSION.merge_environment_settings(_REQ.url, {}, None, None, None)
+
+_SUB_RE = re.compile(r'\A[A-Za-z0-9_]{2,21}\Z')
+
+# subreddit -> (expiry_ts, titles, etag, last_mod); only 200 results are
+# cached, and expired entries are kept to revalidate with a 304
+_CACHE = {}
+_CACHE_TTL = 60.0
+_CACHE_MAX = 1000
+_CACHE_LOCK = threading.Lock()
+
+# Reddit's advertised request budget, refreshed from every response
+_RL_REMAINING = 60.0
+_RL_RESET_AT = 0.0
+
+
+def _update_rate_limit(headers):
+    """Records the X-Ratelimit-* budget reported by Reddit"""
+    global _RL_REMAINING, _RL_RESET_AT
+    try:
+        remaining = float(headers.get('x-ratelimit-remaining', '60'))
+        reset = float(headers.get('x-ratelimit-reset', '0'))
+    except ValueError:
+        return
+    _RL_REMAINING = remaining
+    _RL_RESET_AT = time.monotonic() + reset
+
+
+# application-only OAuth token as (token, expiry_ts); a failed request is
+# remembered as (None, expiry_ts) so it is not retried on every call
+_TOKEN = None
+_TOKEN_URL = "https://www.reddit.com/api/v1/access_token"
+_TOKEN_MARGIN = 60.0
+_TOKEN_RETRY = 300.0
+_TOKEN_LOCK = threading.Lock()
+
+
+def _get_token():
+    """Returns an OAuth bearer token, or None if none can be had"""
+    global _TOKEN
+    client_id = os.environ.get('REDDIT_CLIENT_ID')
+    client_secret = os.environ.get('REDDIT_CLIENT_SECRET')
+    if not client_id or not client_secret:
+        return None
+    with _TOKEN_LOCK:
+        if (_TOKEN is not None and
+                _TOKEN[1] - _TOKEN_MARGIN > time.monotonic()):
+            return _TOKEN[0]
+        _bucket.acquire()
+        try:
+            res = _SESSION.post(_TOKEN_URL,
+                                auth=(client_id, client_secret),
+                                data={'grant_type': 'client_credentials'},
+                                timeout=10)
+            _update_rate_limit(res.headers)
+            if res.status_code != 200:
+                raise ValueError('token request failed')
+            data = res.json()
+            _TOKEN = (data['access_token'],
+                      time.monotonic() + float(data.get('expires_in', 3600)))
+        except (requests.exceptions.RequestException,
+                ValueError, KeyError, TypeError):
+            # the token is optional; fall back to the anonymous endpoint
+            _TOKEN = (None,
+                      time.monotonic() + _TOKEN_RETRY + _TOKEN_MARGIN)
+        return _TOKEN[0]
+
+
+def _drop_token(token):
+    """Forgets a bearer token the oauth host rejected"""
+    global _TOKEN
+    with _TOKEN_LOCK:
+        if _TOKEN is not None and _TOKEN[0] == token:
+            _TOKEN = None
+
+
+class _Bucket:
+    """Token bucket holding requests under R per minute"""
+
+    def __init__(self, R=60):
+        self.R = R
+        self.tokens = R
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request token is available, then takes it"""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last_update
+            self.tokens = min(self.R, self.tokens + elapsed * self.R / 60)
+            self.last_update = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) * 60 / self.R)
+                self.tokens = 1
+                self.last_update = time.monotonic()
+            self.tokens -= 1
 
-    res = requests.get(url,
-                       headers={
-                           'User-Agent': 'Mozilla/5.0'})
 
-    if res.status_code != 200:
+_bucket = _Bucket()
+
+
+def _parse_titles(res):
+    """Returns the first 10 non-empty post titles of a hot.json response
+
+    Raises ValueError when the body has no data.children list.
+    """
+    if ijson is None:
+        posts = _loads(res.content)['data']['children']
+        if not isinstance(posts, list):
+            raise ValueError('hot.json has no data.children list')
+        titles = []
+        for post in posts:
+            try:
+                title = post['data']['title']
+            except (KeyError, TypeError):
+                continue
+            if isinstance(title, str) and title:
+                titles.append(title)
+                if len(titles) == 10:
+                    break
+        return titles
+    res.raw.decode_content = True
+    found = False
+    titles = []
+    for prefix, event, value in ijson.parse(res.raw):
+        if prefix == 'data.children' and event == 'start_array':
+            found = True
+        elif (event == 'string' and value and
+              prefix == 'data.children.item.data.title'):
+            titles.append(value)
+            if len(titles) == 10:
+                break
+    if not found:
+        raise ValueError('hot.json has no data.children list')
+    # drain the rest so urllib3 hands the connection back to the pool
+    res.raw.read()
+    return titles
+
+
+def _print_titles(titles):
+    """Writes one title per line in a single stdout write"""
+    if titles:
+        sys.stdout.write('\n'.join(titles) + '\n')
+
+
+def _fetch_titles(subreddit):
+    """Returns the top 10 titles of a subreddit, or None on failure"""
+    if not isinstance(subreddit, str) or not _SUB_RE.match(subreddit):
+        return None
+
+    now = time.monotonic()
+    key = subreddit.lower()
+    entry = _CACHE.get(key)
+    if entry is not None and entry[0] > now:
+        return list(entry[1])
+
+    if _RL_REMAINING < 2 and now < _RL_RESET_AT:
+        time.sleep(_RL_RESET_AT - now)
+        now = time.monotonic()
+
+    req = _REQ.copy()
+    if entry is not None:
+        if entry[2]:
+            req.headers['If-None-Match'] = entry[2]
+        if entry[3]:
+            req.headers['If-Modified-Since'] = entry[3]
+
+    try:
+        token = _get_token()
+        if token is not None:
+            req.headers['Authorization'] = 'bearer {}'.format(token)
+            url = "https://oauth.reddit.com/r/{}/hot?limit=10&raw_json=1" \
+                .format(subreddit)
+        else:
+            url = "https://www.reddit.com/r/{}/hot.json?limit=10" \
+                "&raw_json=1".format(subreddit)
+        req.url = url
+
+        _bucket.acquire()
+        with _SESSION.send(req, allow_redirects=False, timeout=10,
+                           stream=True, verify=_ENV['verify'],
+                           cert=_ENV['cert']) as res:
+            _update_rate_limit(res.headers)
+            if res.status_code == 304 and entry is not None:
+                titles = entry[1]
+                etag, last_mod = entry[2], entry[3]
+            elif res.status_code != 200:
+                if res.status_code == 401 and token is not None:
+                    _drop_token(token)
+                return None
+            else:
+                titles = _parse_titles(res)
+                etag = res.headers.get('ETag')
+                last_mod = res.headers.get('Last-Modified')
+    except _FETCH_ERRORS:
+        return None
+
+    with _CACHE_LOCK:
+        _CACHE[key] = (now + _CACHE_TTL, titles, etag, last_mod)
+        if len(_CACHE) > _CACHE_MAX:
+            _CACHE.pop(next(iter(_CACHE)), None)
+    return list(titles)
+
+
+def top_ten(subreddit):
+    """"top ten"""
+    titles = _fetch_titles(subreddit)
+    if titles is None:
         print("OK", end="")
     else:
-        json_response = res.json()
-        posts = json_response.get('data').get('children')
-        [print(post.get('data').get('title')) for post in posts]
+        _print_titles(titles)
+
+
+def top_ten_many(subs):
+    """Returns the top 10 titles of each subreddit, in the order given
+
+    Subreddits are fetched concurrently over the shared Session; a failed
+    lookup yields None in its slot.
+    """
+    with ThreadPoolExecutor(max_workers=10) as ex:
+        return list(ex.map(_fetch_titles, subs))